@@ -29,13 +29,45 @@ from __future__ import unicode_literals, division, print_function
 
 import time
 import threading
+import array
 import re
 import math
+import string
+import itertools
 import sys
 import os
 
 from collections import deque
-_collecting = True
+
+# Stored in the frame column for scopes that were not given a frame. The smallest 64-bit integer rather
+# than -1, so a negative frame number passed in by the caller is still reported as its own frame.
+_noFrame = -(1 << 63)
+# Parent id of the top-level scopes on a thread.
+_rootScope = -1
+# Matches each parent scope in a key, which the text report replaces with indentation.
+_parentScopeRe = re.compile("([^:]*::)")
+
+try:
+	_now = time.perf_counter_ns
+except AttributeError:
+	# Older interpreters have no integer clock; scale the float one to nanoseconds instead.
+	def _now():
+		return int(time.time() * 1000000000)
+
+try:
+	# str() because unicode_literals would otherwise hand Python 2's array a unicode typecode
+	array.array(str("q"))
+	def _column(typecode):
+		return array.array(str(typecode))
+except ValueError:
+	# Python 2's array has no 64-bit typecodes; plain lists hold the same values, just less compactly.
+	def _column(_):
+		return []
+
+# Shared with PerfTimer as class attributes, but kept at module level as well so the timer's
+# __enter__/__exit__ reach them with a single global lookup.
+_perfStack = threading.local()
+_scopeNodes = {}
 
 class ReportMode(object):
 	"""
@@ -49,11 +81,15 @@ def EnablePerfTracking(enable=True):
 	"""
 	Enable (or disable) the perf timer.
 
+	This swaps out the class bound to ``perf_timer.PerfTimer``; while disabled it is a stand-in whose
+	timers do nothing at all. Code that imported the name directly (``from perf_timer import PerfTimer``)
+	keeps whichever class was bound at import time.
+
 	:param enable: True to enable the perf timer, False to disable.
 	:type enable: bool
 	"""
-	global _collecting
-	_collecting = enable
+	global PerfTimer
+	PerfTimer = _RealPerfTimer if enable else _NullPerfTimer
 
 def DisablePerfTracking():
 	"""
@@ -61,7 +97,29 @@ def DisablePerfTracking():
 	"""
 	EnablePerfTracking(False)
 
-_htmlHeader = """<!DOCTYPE html><HTML>
+class _Template(object):
+	"""
+	A str.format() template with positional fields, parsed on first use and then rendered by joining its
+	pieces, rather than re-parsing the whole (multi-kilobyte) string on every call.
+	"""
+	def __init__(self, text):
+		self.text = text
+		self.chunks = None
+
+	def format(self, *args):
+		if self.chunks is None:
+			self.chunks = [
+				(literal, None if field is None else int(field))
+				for literal, field, _, _ in string.Formatter().parse(self.text)
+			]
+		parts = []
+		for literal, field in self.chunks:
+			parts.append(literal)
+			if field is not None:
+				parts.append(str(args[field]))
+		return "".join(parts)
+
+_htmlHeader = _Template("""<!DOCTYPE html><HTML>
 	<HEAD>
 		<title>Perf report for {0}</title>
 		<script type="text/javascript">
@@ -119,10 +177,10 @@ _htmlHeader = """<!DOCTYPE html><HTML>
 		<div id="errorbar" style="background-color:#ff0000"></div>
 		<script type="text/javascript" src="https://www.gstatic.com/charts/loader.js" onload="scriptLoaded=true;" ></script>
 		<h1>Perf Report: <i>{0} {1}</i></h1>
-"""
+""")
 
 _blocks = [
-"""		<div style="margin:2px 10px;padding: 5px 10px;background-color:lavender;border: 1px solid grey;">
+_Template("""		<div style="margin:2px 10px;padding: 5px 10px;background-color:lavender;border: 1px solid grey;">
 			<h3>{1}</h3>
 
 			<div id="chart_div_{0}"></div>
@@ -136,8 +194,8 @@ _blocks = [
 					data.addColumn("number", "Exclusive time in milliseconds");
 					data.addColumn("number", "Inclusive time in milliseconds");
 					data.addRows([
-""",
-"""					]);
+"""),
+_Template("""					]);
 					var tree = new google.visualization.TreeMap(document.getElementById("chart_div_{0}"));
 					function showFullTooltip(row, size, value) {{
 						return '<div style="background:#fd9; padding:10px; border-style:solid">' +
@@ -166,8 +224,8 @@ _blocks = [
 			</script>
 			<script type="text/javascript">
 				var datas_{0} = [
-""",
-"""				function HideChildren_{0}(parentId) {{
+"""),
+_Template("""				function HideChildren_{0}(parentId) {{
 						className = '{0}_Parent_' + parentId
 						elems = document.getElementsByClassName(className)
 						arrowElem = document.getElementById("arrow_{0}_"+parentId)
@@ -433,18 +491,56 @@ _blocks = [
 				Populate_{0}(1);
 			</script>
 		</div>
-"""
+""")
 ]
 
 _htmlFooter = """	</BODY>
 </HTML>"""
 
 
+class _PerfRecords(object):
+	"""
+	Column store for the scopes completed on a single thread, one array per field.
+	Only the owning thread appends to it, so recording a scope takes no locks.
+	"""
+	def __init__(self):
+		self.thread = threading.current_thread()
+		self.scopeIds = _column("q")
+		self.inc = _column("q")
+		self.exc = _column("q")
+		self.tid = _column("Q")
+		self.frame = _column("q")
+		self.incstart = _column("q")
+		self.end = _column("q")
+		# Scopes shorter than PerfTimer.minScopeNs, pre-aggregated into one report row (plus the first start and last end)
+		# per (scope id, thread, frame). Only the owning thread adds to it; the report drains it with popitem.
+		self.shortRows = {}
+
+	def columns(self):
+		return (self.scopeIds, self.inc, self.exc, self.tid, self.frame, self.incstart, self.end)
+
+	def record(self, scopeId, inclusive, exclusive, threadId, frame, incstart, end):
+		self.scopeIds.append(scopeId)
+		self.inc.append(inclusive)
+		self.exc.append(exclusive)
+		self.tid.append(threadId)
+		self.frame.append(_noFrame if frame is None else frame)
+		self.incstart.append(incstart)
+		# Appended last, so any row counted by the length of this column is complete in all the others.
+		self.end.append(end)
+
+def _frameNumber(frame):
+	# Frames are stored in an integer column, so check them when the timer is made rather than when it exits
+	intFrame = int(frame)
+	if intFrame != frame:
+		raise ValueError("PerfTimer frame must be a whole number, got {!r}".format(frame))
+	return intFrame
+
 def _formatTime(totaltime):
-	msec = totaltime*1000
-	return "{:.2f}".format(msec)
+	# Always milliseconds, so the report columns line up; %-formatting skips parsing a format spec per call
+	return "%.2f" % (totaltime * 1000)
 
-class PerfTimer(object):
+class _RealPerfTimer(object):
 	"""
 	Performance timer to collect performance stats on csbuild to aid in diagnosing slow builds.
 	Used as a context manager around a block of code, will store cumulative execution time for that block.
@@ -452,65 +548,148 @@ class PerfTimer(object):
 	:param blockName: The name of the block to store execution for.
 	:type blockName: str
 	:param frame: A frame counter for frame-based programs. If this is set, the HTML output mode
-		will generate multiple pages, one for each frame, and a performance graph by frame.
+		will generate multiple pages, one for each frame, and a performance graph by frame. Must be a whole
+		number; a float such as 2.0 is converted to an int, and one with a fractional part raises ValueError.
 	:type frame: int or None
 	"""
-	perfQueue = deque()
+	__slots__ = ("frame", "blockName", "incstart", "excstart", "exclusive", "inclusive", "scopeId")
+
+	# Scopes are interned as (parent scope id, block name) nodes, so each record only stores an integer id
+	# and the full "a::b::c" names are only built at report time, once per unique scope.
+	_scopeNodes = _scopeNodes
+	_scopeParents = []
+	_scopeBlocks = []
+	_scopeLock = threading.Lock()
+	# Every thread's _PerfRecords, so the report can merge them. Only touched once per thread and at report time.
+	_allRecords = []
+	_allRecordsLock = threading.Lock()
 	annotations = deque()
-	perfStack = threading.local()
+	perfStack = _perfStack
 	minFrameTime = None
+	minScopeNs = 0
 	
 	@staticmethod
 	def setMinFrameTime(minTime):
-		PerfTimer.minFrameTime = minTime
+		_RealPerfTimer.minFrameTime = minTime
+
+	@staticmethod
+	def setMinScopeNs(minNs):
+		"""
+		Scopes shorter than this many nanoseconds are only counted towards a per-scope aggregate rather than
+		stored individually, which keeps memory and report time down for very hot, very short blocks.
+		"""
+		_RealPerfTimer.minScopeNs = minNs
 
 	def __init__(self, blockName, frame=None):
-		if _collecting:
-			self.frame = frame
-			self.blockName = blockName
-			self.incstart = 0
-			self.excstart = 0
-			self.exclusive = 0
-			self.inclusive = 0
-			self.scopeName = blockName
-			self.threadId = threading.current_thread().ident
+		if frame is not None:
+			frame = _frameNumber(frame)
+		self.frame = frame
+		self.blockName = blockName
+		self.incstart = 0
+		self.excstart = 0
+		self.exclusive = 0
+		self.inclusive = 0
+		self.scopeId = None
 
 	def __enter__(self):
-		if _collecting:
-			now = time.time()
-			try:
-				prev = PerfTimer.perfStack.stack[-1]
-				prev.exclusive += now - prev.excstart
-				self.scopeName = prev.scopeName + "::" + self.blockName
-
-				PerfTimer.perfStack.stack.append(self)
-			except:
-				PerfTimer.perfStack.stack = [self]
-
-			self.incstart = now
-			self.excstart = now
+		now = _now()
+		perfStack = _perfStack
+		stack = getattr(perfStack, "stack", None)
+		parentId = _rootScope
+		if stack is None:
+			# First scope on this thread
+			stack = perfStack.stack = []
+			perfStack.tid = threading.current_thread().ident
+			_RealPerfTimer._threadRecords()
+		elif stack:
+			prev = stack[-1]
+			prev.exclusive += now - prev.excstart
+			parentId = prev.scopeId
+		blockName = self.blockName
+		scopeId = _scopeNodes.get((parentId, blockName))
+		if scopeId is None:
+			scopeId = _RealPerfTimer._internScope(parentId, blockName)
+		self.scopeId = scopeId
+		stack.append(self)
+
+		self.incstart = now
+		self.excstart = now
 		return self
 
 	def __exit__(self, excType, excVal, excTb):
-		if _collecting:
-			now = time.time()
-			try:
-				prev = PerfTimer.perfStack.stack[-2]
-				prev.excstart = now
-			except:
-				pass
-
-			self.exclusive += now - self.excstart
-			self.inclusive = now - self.incstart
-
-			PerfTimer.perfQueue.append((self.scopeName, self.inclusive, self.exclusive, self.threadId, self.frame, self.incstart, now))
-			PerfTimer.perfStack.stack.pop()
-			
+		now = _now()
+		perfStack = _perfStack
+		stack = perfStack.stack
+		if len(stack) >= 2:
+			stack[-2].excstart = now
+
+		exclusive = self.exclusive = self.exclusive + now - self.excstart
+		inclusive = self.inclusive = now - self.incstart
+
+		# Same as _PerfRecords.record(), written out here to save a call on every scope
+		records = perfStack.records
+		if inclusive < _RealPerfTimer.minScopeNs:
+			key = (self.scopeId, perfStack.tid, self.frame)
+			shortRows = records.shortRows
+			# Taken out of the dict while it is updated, so the report (which drains the dict with popitem)
+			# either gets the row before this sample or after it, never while it is half-written.
+			row = shortRows.pop(key, None)
+			if row is None:
+				# Same layout as a report row (inclusive, exclusive, count, max inc, max exc, min inc, min exc),
+				# followed by the first start and last end, which give the frame its extent in the report
+				row = [inclusive, exclusive, 1, inclusive, exclusive, inclusive, exclusive, self.incstart, now]
+			else:
+				row[0] += inclusive
+				row[1] += exclusive
+				row[2] += 1
+				if inclusive > row[3]:
+					row[3] = inclusive
+				if exclusive > row[4]:
+					row[4] = exclusive
+				if inclusive < row[5]:
+					row[5] = inclusive
+				if exclusive < row[6]:
+					row[6] = exclusive
+				row[8] = now
+			shortRows[key] = row
+			stack.pop()
+			return
+		records.scopeIds.append(self.scopeId)
+		records.inc.append(inclusive)
+		records.exc.append(exclusive)
+		records.tid.append(perfStack.tid)
+		records.frame.append(_noFrame if self.frame is None else self.frame)
+		records.incstart.append(self.incstart)
+		records.end.append(now)
+		stack.pop()
+
+	@staticmethod
+	def _threadRecords():
+		records = getattr(_RealPerfTimer.perfStack, "records", None)
+		if records is None:
+			records = _PerfRecords()
+			with _RealPerfTimer._allRecordsLock:
+				_RealPerfTimer._allRecords.append(records)
+			_RealPerfTimer.perfStack.records = records
+		return records
+
+	@staticmethod
+	def _internScope(parentId, blockName):
+		key = (parentId, blockName)
+		with _RealPerfTimer._scopeLock:
+			scopeId = _RealPerfTimer._scopeNodes.get(key)
+			if scopeId is None:
+				scopeId = len(_RealPerfTimer._scopeBlocks)
+				_RealPerfTimer._scopeParents.append(parentId)
+				_RealPerfTimer._scopeBlocks.append(blockName)
+				# Published last, so a lock-free lookup that finds the id also finds its parent and block.
+				_RealPerfTimer._scopeNodes[key] = scopeId
+			return scopeId
+
 	@staticmethod
 	def Note(txt, frame=None):
-		if _collecting:
-			now = time.time()
-			PerfTimer.annotations.append((txt, threading.current_thread().ident, frame, now))
+		now = _now()
+		_RealPerfTimer.annotations.append((txt, threading.current_thread().ident, frame, now))
 
 	@staticmethod
 	def PrintPerfReport(reportMode, output=None, name=None):
@@ -541,52 +720,95 @@ class PerfTimer(object):
 			else:
 				output = os.path.basename(os.path.splitext(name)[0] + "_PERF.html")
 
+		# Merge the records from every thread into a single column store for the report
+		records = _PerfRecords()
+		shortRows = []
+		with _RealPerfTimer._allRecordsLock:
+			allRecords = list(_RealPerfTimer._allRecords)
+		for threadRecords in allRecords:
+			alive = threadRecords.thread.is_alive()
+			count = len(threadRecords.end)
+			for merged, column in zip(records.columns(), threadRecords.columns()):
+				merged.extend(column[:count])
+				del column[:count]
+			# popitem rather than swapping the dict out, so a row the owning thread is updating right now
+			# stays with that thread and turns up in the next report instead of being lost
+			threadShortRows = threadRecords.shortRows
+			for _ in range(len(threadShortRows)):
+				try:
+					shortRows.append(threadShortRows.popitem())
+				except KeyError:
+					break
+			if not alive:
+				with _RealPerfTimer._allRecordsLock:
+					_RealPerfTimer._allRecords.remove(threadRecords)
+
+		# Bucket the records into per-frame lists of indices into the columns
 		elementsByFrame = {}
 		earliestByFrame = {}
 		latestByFrame = {}
-		allFramesQueue = deque()
 		allFramesAnnotations = deque()
 		annotationsByFrame = {}
-		while True:
-			try:
-				pair = PerfTimer.perfQueue.popleft()
-				frame = pair[4]
-				if frame in earliestByFrame:
-					earliestByFrame[frame] = min(earliestByFrame[frame], pair[5])
-					latestByFrame[frame] = max(latestByFrame[frame], pair[6])
-				else:
-					earliestByFrame[frame] = pair[5]
-					latestByFrame[frame] = pair[6]
-				if PerfTimer.minFrameTime is not None and (duration * 1000) < PerfTimer.minFrameTime:
-					continue
-				elementsByFrame.setdefault(frame, deque()).append(pair)
-				annotationsByFrame[frame] = deque();
-				allFramesQueue.append(pair)
-			except IndexError:
-				break
-
-		while True:
-			try:
-				pair = PerfTimer.annotations.popleft()
-				frame = pair[2]
-				globalEarliest = min(earliestByFrame.values())
-				allFramesPair = (pair[0], pair[1], pair[2], pair[3] - globalEarliest)
-				allFramesAnnotations.append(allFramesPair)
-				# Convert timestamp to a relative timestamp for this frame
-				pair = (pair[0], pair[1], pair[2], pair[3] - earliestByFrame[frame])
-				annotationsByFrame[frame].append(pair)
-			except IndexError:
-				break
+		frameCol = records.frame
+		incstartCol = records.incstart
+		endCol = records.end
+		for i in range(len(endCol)):
+			frame = frameCol[i]
+			if frame == _noFrame:
+				frame = None
+			elementsByFrame.setdefault(frame, []).append(i)
+		# A frame whose scopes were all shorter than minScopeNs only has short rows, but still gets a bucket
+		shortRowsByFrame = {}
+		for shortRow in shortRows:
+			frame = shortRow[0][2]
+			shortRowsByFrame.setdefault(frame, []).append(shortRow)
+			elementsByFrame.setdefault(frame, [])
+
+		# One min/max reduction per frame over its bucket, rather than a comparison per record.
+		# Frames that took less than minFrameTime milliseconds are left out of the report entirely.
+		minFrameNs = None
+		if _RealPerfTimer.minFrameTime is not None:
+			minFrameNs = _RealPerfTimer.minFrameTime * 1000000
+		allFramesIndices = range(len(endCol))
+		droppedFrames = False
+		for frame, frameIndices in list(elementsByFrame.items()):
+			frameShortRows = shortRowsByFrame.get(frame, ())
+			earliest = min(itertools.chain(map(incstartCol.__getitem__, frameIndices), (row[7] for _, row in frameShortRows)))
+			latest = max(itertools.chain(map(endCol.__getitem__, frameIndices), (row[8] for _, row in frameShortRows)))
+			if minFrameNs is not None and latest - earliest < minFrameNs:
+				del elementsByFrame[frame]
+				shortRowsByFrame.pop(frame, None)
+				droppedFrames = True
+				continue
+			earliestByFrame[frame] = earliest
+			latestByFrame[frame] = latest
+			annotationsByFrame[frame] = deque()
+		if droppedFrames:
+			allFramesIndices = sorted(itertools.chain.from_iterable(elementsByFrame.values()))
+			shortRows = [shortRow for shortRow in shortRows if shortRow[0][2] in elementsByFrame]
+
+		# Swap in a fresh queue and walk the old one, rather than popping the notes off one at a time
+		annotations, _RealPerfTimer.annotations = _RealPerfTimer.annotations, deque()
+		if earliestByFrame:
+			globalEarliest = min(earliestByFrame.values())
+		for pair in annotations:
+			frame = pair[2]
+			if frame not in annotationsByFrame:
+				continue
+			allFramesPair = (pair[0], pair[1], pair[2], (pair[3] - globalEarliest) / 1e9)
+			allFramesAnnotations.append(allFramesPair)
+			# Convert timestamp to a relative timestamp for this frame
+			pair = (pair[0], pair[1], pair[2], (pair[3] - earliestByFrame[frame]) / 1e9)
+			annotationsByFrame[frame].append(pair)
 				
 		if len(elementsByFrame) > 1 and reportMode == ReportMode.HTML:
 			if not os.path.exists(os.path.join(os.path.dirname(output), "frames")):
 				os.mkdir(os.path.join(os.path.dirname(output), "frames"))
 			if __name__ == "__main__":
 				print("Generating combined frame output...")
-			PerfTimer.perfQueue = allFramesQueue
-			#PerfTimer.annotations = allFramesAnnotations
+			#_RealPerfTimer.annotations = allFramesAnnotations
 			thisOutput = os.path.join(os.path.dirname(output), "frames", "_ALL.".join(os.path.basename(output).rsplit(".", 1)))
-			PerfTimer._printPerfReport(reportMode, thisOutput, None, name)
+			_RealPerfTimer._printPerfReport(reportMode, thisOutput, None, name, records, allFramesIndices, shortRows)
 
 		for key in sorted(elementsByFrame.keys()):
 			if key is not None:
@@ -596,13 +818,11 @@ class PerfTimer(object):
 					output("==============================")
 				elif __name__ == "__main__":
 					sys.stdout.write("\rGenerating individual frame output for frame {}...".format(key))
-			duration = latestByFrame[key] - earliestByFrame[key]
-			PerfTimer.perfQueue = elementsByFrame[key]
-			PerfTimer.annotations = annotationsByFrame[key]
+			_RealPerfTimer.annotations = annotationsByFrame[key]
 			thisOutput = output
 			if len(elementsByFrame) > 1 and reportMode == ReportMode.HTML:
 				thisOutput = os.path.join(os.path.dirname(output), "frames", "_{}.".format(key).join(os.path.basename(output).rsplit(".", 1)))
-			PerfTimer._printPerfReport(reportMode, thisOutput, key, name)
+			_RealPerfTimer._printPerfReport(reportMode, thisOutput, key, name, records, elementsByFrame[key], shortRowsByFrame.get(key, ()))
 
 		if len(elementsByFrame) > 1 and reportMode == ReportMode.HTML:
 			if __name__ == "__main__":
@@ -634,7 +854,7 @@ html, body { height: 100%; }
   </iframe>
 <script type="text/javascript">
 const dataX = """ + str(list(sorted(elementsByFrame.keys()))) + """;
-const dataY = """ + str([(latestByFrame[key] - earliestByFrame[key]) * 1000 for key in sorted(elementsByFrame.keys())]) + """;
+const dataY = """ + str([(latestByFrame[key] - earliestByFrame[key]) / 1e6 for key in sorted(elementsByFrame.keys())]) + """;
 const data = [
   {
     x: dataX,
@@ -683,11 +903,11 @@ Plotly.newPlot(
 document.getElementById('plot').on('plotly_click', singleClickHandler);
 
 function singleClickHandler(data) {
-  let pn = data.points[0].pointNumber + 1;
+  let pn = data.points[0].x;
   document.getElementById("frameData").src = `./""" + frameFile + """`;
   let tn = data.points[0].curveNumber;
   let colors = new Array(data.points[0].data.x.length).fill("#1f77b4")
-  colors[pn-1] = '#C54C82';
+  colors[data.points[0].pointNumber] = '#C54C82';
   var update = {'marker':{color: colors, size:16}};
   Plotly.restyle('plot', update,[tn]);
 }
@@ -695,12 +915,12 @@ function singleClickHandler(data) {
 </body>
 </html>
 """
-			with open(output, "w") as f:
-				f.write(html)
+			with open(output, "wb") as f:
+				f.write(html.encode("utf-8"))
 
 
 	@staticmethod
-	def _printPerfReport(reportMode, output, frameId, name):
+	def _printPerfReport(reportMode, output, frameId, name, records, indices, shortRows):
 		fullreport = {}
 		threadreports = {}
 
@@ -713,310 +933,372 @@ function singleClickHandler(data) {
 			MaxExc = 4
 			MinInc = 5
 			MinExc = 6
-
-		while True:
-			try:
-				pair = PerfTimer.perfQueue.popleft()
+			IncMean = 7
+			ExcMean = 8
+
+		# Aggregate the records on their interned scope ids first, so the scope name strings
+		# are only built once per unique scope rather than once per record. Each (thread, scope id)
+		# pair gets a row number, and the row's values are kept in parallel lists indexed by it.
+		scopeCol = records.scopeIds
+		incCol = records.inc
+		excCol = records.exc
+		tidCol = records.tid
+		rowIdsByThread = {}
+		rowKeys = []
+		incs = []
+		excs = []
+		counts = []
+		maxIncs = []
+		maxExcs = []
+		minIncs = []
+		minExcs = []
+		for i in indices:
+			threadId = tidCol[i]
+			rowIds = rowIdsByThread.get(threadId)
+			if rowIds is None:
+				rowIds = rowIdsByThread[threadId] = {}
+			scopeId = scopeCol[i]
+			inclusive = incCol[i]
+			exclusive = excCol[i]
+			row = rowIds.get(scopeId)
+			if row is None:
+				rowIds[scopeId] = len(rowKeys)
+				rowKeys.append((threadId, scopeId))
+				incs.append(inclusive)
+				excs.append(exclusive)
+				counts.append(1)
+				maxIncs.append(inclusive)
+				maxExcs.append(exclusive)
+				minIncs.append(inclusive)
+				minExcs.append(exclusive)
+				continue
+			incs[row] += inclusive
+			excs[row] += exclusive
+			counts[row] += 1
+			if inclusive > maxIncs[row]:
+				maxIncs[row] = inclusive
+			if exclusive > maxExcs[row]:
+				maxExcs[row] = exclusive
+			if inclusive < minIncs[row]:
+				minIncs[row] = inclusive
+			if exclusive < minExcs[row]:
+				minExcs[row] = exclusive
+
+		def _mergeRow(report, key, row):
+			reportEntry = report.get(key)
+			if reportEntry is None:
+				report[key] = list(row)
+				return
+			inclusive, exclusive, count, maxInc, maxExc, minInc, minExc = row
+			reportEntry[Position.Inclusive] += inclusive
+			reportEntry[Position.Exclusive] += exclusive
+			reportEntry[Position.Count] += count
+			if maxInc > reportEntry[Position.MaxInc]:
+				reportEntry[Position.MaxInc] = maxInc
+			if maxExc > reportEntry[Position.MaxExc]:
+				reportEntry[Position.MaxExc] = maxExc
+			if minInc < reportEntry[Position.MinInc]:
+				reportEntry[Position.MinInc] = minInc
+			if minExc < reportEntry[Position.MinExc]:
+				reportEntry[Position.MinExc] = minExc
+
+		# Resolve each scope id to its report key (just the leaf block name in flat mode, which
+		# can merge several ids into one key) and build the per-thread and cumulative reports.
+		# Full names are built from the parent's name, which is itself only built once.
+		scopeParents = _RealPerfTimer._scopeParents
+		scopeBlocks = _RealPerfTimer._scopeBlocks
+		keysById = {}
+		def _keyForId(scopeId):
+			key = keysById.get(scopeId)
+			if key is None:
+				key = scopeBlocks[scopeId]
 				if reportMode == ReportMode.FLAT:
-					split = pair[0].rsplit("::", 1)
-					if len(split) == 2:
-						key = split[1]
-					else:
-						key = split[0]
-					pair = (
-						key,
-						pair[1],
-						pair[2],
-						pair[3]
-					)
-
-				fullreport.setdefault(pair[0], [0,0,0,0,0,999999999,999999999])
-				fullreport[pair[0]][Position.Inclusive] += pair[1]
-				fullreport[pair[0]][Position.Exclusive] += pair[2]
-				fullreport[pair[0]][Position.Count] += 1
-				fullreport[pair[0]][Position.MaxInc] = max(pair[1], fullreport[pair[0]][Position.MaxInc])
-				fullreport[pair[0]][Position.MaxExc] = max(pair[2], fullreport[pair[0]][Position.MaxExc])
-				fullreport[pair[0]][Position.MinInc] = min(pair[1], fullreport[pair[0]][Position.MinInc])
-				fullreport[pair[0]][Position.MinExc] = min(pair[2], fullreport[pair[0]][Position.MinExc])
-
-				threadreport = threadreports.setdefault(pair[3], {})
-				threadreport.setdefault(pair[0], [0,0,0,0,0,999999999,999999999])
-				threadreport[pair[0]][Position.Inclusive] += pair[1]
-				threadreport[pair[0]][Position.Exclusive] += pair[2]
-				threadreport[pair[0]][Position.Count] += 1
-				threadreport[pair[0]][Position.MaxInc] = max(pair[1], threadreport[pair[0]][Position.MaxInc])
-				threadreport[pair[0]][Position.MaxExc] = max(pair[2], threadreport[pair[0]][Position.MaxExc])
-				threadreport[pair[0]][Position.MinInc] = min(pair[1], threadreport[pair[0]][Position.MinInc])
-				threadreport[pair[0]][Position.MinExc] = min(pair[2], threadreport[pair[0]][Position.MinExc])
-			except IndexError:
-				break
-
-		annotations = []
-		while True:
-			try:
-				pair = PerfTimer.annotations.popleft()
-			except IndexError:
-				break
-			else:
-				annotations.append(pair)
+					# A block name can itself contain "::", and only the part after the last one is the leaf
+					key = key.rpartition("::")[2]
+				elif scopeParents[scopeId] != _rootScope:
+					key = _keyForId(scopeParents[scopeId]) + "::" + key
+				keysById[scopeId] = key
+			return key
+
+		for row, (threadId, scopeId) in enumerate(rowKeys):
+			key = _keyForId(scopeId)
+			reportEntry = [incs[row], excs[row], counts[row], maxIncs[row], maxExcs[row], minIncs[row], minExcs[row]]
+			_mergeRow(threadreports.setdefault(threadId, {}), key, reportEntry)
+			_mergeRow(fullreport, key, reportEntry)
+
+		# Fold in the pre-aggregated rows of scopes that were shorter than minScopeNs
+		for (scopeId, threadId, _), shortRow in shortRows:
+			key = _keyForId(scopeId)
+			# Leave off the start and end times that follow the report fields
+			reportEntry = shortRow[:7]
+			_mergeRow(threadreports.setdefault(threadId, {}), key, reportEntry)
+			_mergeRow(fullreport, key, reportEntry)
+
+		# Timings are collected as integer nanoseconds; convert them to seconds once here for display.
+		# The means are worked out here too, so every printer can read them from the row.
+		for report in [fullreport] + list(threadreports.values()):
+			for reportEntry in report.values():
+				for position in (Position.Inclusive, Position.Exclusive, Position.MaxInc, Position.MaxExc, Position.MinInc, Position.MinExc):
+					reportEntry[position] /= 1e9
+				reportEntry.append(reportEntry[Position.Inclusive] / reportEntry[Position.Count])
+				reportEntry.append(reportEntry[Position.Exclusive] / reportEntry[Position.Count])
+
+		annotations, _RealPerfTimer.annotations = _RealPerfTimer.annotations, deque()
 				
 		if not fullreport:
 			return
 
+		# Scopes are listed by inclusive time in tree mode and by exclusive time otherwise. The mode is
+		# only checked once here rather than in the sort key for every scope.
+		sortPosition = Position.Inclusive if reportMode == ReportMode.TREE else Position.Exclusive
+		def _sortedKeys(report):
+			return sorted(report, reverse=True, key=lambda key: report[key][sortPosition])
+
+		# The thread producing the report is listed as the main thread
+		mainIdent = threading.current_thread().ident
+
 		if reportMode == ReportMode.HTML:
-			with open(output, "w") as f:
-				#pylint: disable=missing-docstring
-				class SharedLocals(object):
-					identifiers = {}
-					lastId = {}
-					totalExc = 0
-					totalCount = 0
-					maxExcMean = 0
-					maxIncMean = 0
-					maxExcMax = 0
-					maxExcMin = 0
-					maxIncMax = 0
-					maxIncMin = 0
-
-				#pylint: disable=invalid-name
-				def _getIdentifier(s):
-					_,_,base = s.rpartition("::")
-					if s not in SharedLocals.identifiers:
-						SharedLocals.identifiers[s] = SharedLocals.lastId.setdefault(base, 0)
-						SharedLocals.lastId[base] += 1
-					return base + "\\x0b" * SharedLocals.identifiers[s]
-
-				def _recurseHtml(report, sortedKeys, prefix, printed, itemfmt, indent):
-					first = True
-					for key in sortedKeys:
-						if key in printed:
-							continue
-
-						if key.startswith(prefix):
-							reportEntry = report[key]
-							reportIncMean = reportEntry[Position.Inclusive] / reportEntry[Position.Count]
-							reportExcMean = reportEntry[Position.Exclusive] / reportEntry[Position.Count]
-
-							printkey = key.replace(prefix, "", 1)
-							if printkey.find("::") != -1:
-								continue
-							if not first:
-								f.write("\t" * (indent+1))
-								f.write("],\n")
-							f.write("\n")
-							f.write("\t" * (indent+1))
-							f.write(
-								itemfmt.format(
-									printkey,
-									reportEntry[Position.Inclusive],
-									reportEntry[Position.Exclusive],
-									reportEntry[Position.Count],
-									reportEntry[Position.MaxInc],
-									reportEntry[Position.MinInc],
-									reportIncMean,
-									reportEntry[Position.MaxExc],
-									reportEntry[Position.MinExc],
-									reportExcMean,
-								)
-							)
-
-							SharedLocals.totalExc += reportEntry[Position.Exclusive]
-							SharedLocals.totalCount += reportEntry[Position.Count]
-							SharedLocals.maxExcMean = max(SharedLocals.maxExcMean, reportExcMean)
-							SharedLocals.maxIncMean = max(SharedLocals.maxIncMean, reportIncMean)
-							SharedLocals.maxExcMax = max(SharedLocals.maxExcMax, reportEntry[Position.MaxExc])
-							SharedLocals.maxIncMax = max(SharedLocals.maxIncMax, reportEntry[Position.MaxInc])
-							SharedLocals.maxExcMin = max(SharedLocals.maxExcMin, reportEntry[Position.MinExc])
-							SharedLocals.maxIncMin = max(SharedLocals.maxIncMin, reportEntry[Position.MinInc])
-
-							f.write("\t" * (indent+2))
-							f.write("[")
-							printed.add(key)
-							_recurseHtml(report, sortedKeys, key + "::", printed, itemfmt, indent + 2)
-							first = False
-					if not first:
-						f.write("\t" * (indent+1))
-						f.write("]\n")
-						f.write("\t" * indent)
-					f.write("]\n")
-
-				def _printReportHtml(report, threadId, numericThreadId):
-					if not report:
-						return
-					totalcount = 0
-					for key in report:
-						totalcount += report[key][Position.Count]
-
-					sortedKeys = sorted(report, reverse=True, key=lambda x: report[x][0] if reportMode == ReportMode.TREE else report[x][1])
-
-					threadScriptId = threadId.replace(" ", "_")
-					f.write(_blocks[0].format(threadScriptId, threadId))
-
-					f.write("\t\t\t\t\t\t['<{}_root>', null, 0, 0 ],\n".format(threadScriptId))
-					for key in sortedKeys:
-						parent, _, thisKey = key.rpartition("::")
-						ident = _getIdentifier(key)
-						f.write("\t\t\t\t\t\t['" + ident + "', ")
-						if parent:
-							f.write("'" + _getIdentifier(parent) + "', ")
-						else:
-							f.write("'<{}_root>',".format(threadScriptId))
-						f.write(str(report[key][0]))
-						f.write(", ")
-						f.write(str(report[key][0]))
-						f.write("],\n")
-
-						exclusiveIdent = _getIdentifier(key + "::<inside " +thisKey + ">")
-						f.write("\t\t\t\t\t\t['" + exclusiveIdent + "', ")
-						f.write("'" + ident + "', ")
-						f.write(str(max(report[key][1], 0.0000000001)))
-						f.write(", ")
-						f.write(str(max(report[key][1], 0.0000000001)))
-						f.write("],\n")
-
-					f.write(_blocks[1].format(threadScriptId, threadId))
-
-					itemfmt = "[ \"{}\", {}, {}, {}, {}, {}, {}, {}, {}, {},\n"
-					printed = set()
-					first = True
-					for key in sortedKeys:
-						reportEntry = report[key]
-						reportIncMean = reportEntry[Position.Inclusive] / reportEntry[Position.Count]
-						reportExcMean = reportEntry[Position.Exclusive] / reportEntry[Position.Count]
-
-						if key in printed:
-							continue
-						if key.find("::") != -1:
-							continue
-						if not first:
-							f.write("\t\t\t\t\t],\n")
-						f.write("\t\t\t\t\t")
-						f.write(
-							itemfmt.format(
-								key,
-								reportEntry[Position.Inclusive],
-								reportEntry[Position.Exclusive],
-								reportEntry[Position.Count],
-								reportEntry[Position.MaxInc],
-								reportEntry[Position.MinInc],
-								reportIncMean,
-								reportEntry[Position.MaxExc],
-								reportEntry[Position.MinExc],
-								reportExcMean,
-							)
-						)
+			# The whole page is built up in memory and written out in one go
+			buf = []
+			write = buf.append
+			#pylint: disable=missing-docstring
+			class SharedLocals(object):
+				identifiers = {}
+				lastId = {}
+				# Running totals across the whole page, in the order of each thread's totals_ array: total exc,
+				# total count, then the largest max, min and mean of inclusive and then of exclusive times
+				totals = [0, 0, 0, 0, 0, 0, 0, 0]
+
+			#pylint: disable=invalid-name
+			def _getIdentifier(s):
+				# Keys are looked up several times each (as a node and as a parent), so the finished
+				# identifier is kept for the rest of this report
+				ident = SharedLocals.identifiers.get(s)
+				if ident is None:
+					base = s.rpartition("::")[2]
+					count = SharedLocals.lastId.get(base, 0)
+					SharedLocals.lastId[base] = count + 1
+					ident = SharedLocals.identifiers[s] = base + "\\x0b" * count
+				return ident
+
+			def _recurseHtml(report, children, parentKey, itemfmt, indent):
+				# Walks the subtree with an explicit stack rather than recursing, so deep scope trees can't hit
+				# the recursion limit. Each level is [remaining children, prefix length, indent, separator, closing].
+				totals = SharedLocals.totals
+				indentStr = "\t" * indent
+				levels = [[iter(children.get(parentKey, ())), len(parentKey) + 2, indentStr, "\n" + indentStr + "\t", "]\n"]]
+				while levels:
+					level = levels[-1]
+					key = next(level[0], None)
+					if key is None:
+						levels.pop()
+						write(level[4])
+						continue
 
-						SharedLocals.totalExc += reportEntry[Position.Exclusive]
-						SharedLocals.totalCount += reportEntry[Position.Count]
-						SharedLocals.maxExcMean = max(SharedLocals.maxExcMean, reportExcMean)
-						SharedLocals.maxIncMean = max(SharedLocals.maxIncMean, reportIncMean)
-						SharedLocals.maxExcMax = max(SharedLocals.maxExcMax, reportEntry[Position.MaxExc])
-						SharedLocals.maxIncMax = max(SharedLocals.maxIncMax, reportEntry[Position.MaxInc])
-						SharedLocals.maxExcMin = max(SharedLocals.maxExcMin, reportEntry[Position.MinExc])
-						SharedLocals.maxIncMin = max(SharedLocals.maxIncMin, reportEntry[Position.MinInc])
-						f.write("\t\t\t\t\t\t[")
-
-						_recurseHtml(report, sortedKeys, key + "::", printed, itemfmt, 6)
-						first = False
-
-					f.write(
-						"\t\t\t\t\t]"
-						"\n\t\t\t\t]"
-					)
-					f.write("\n\t\t\t\tvar totals_{} = [{}, {}, {}, {}, {}, {}, {}, {}]\n".format(
-						threadScriptId, SharedLocals.totalExc, SharedLocals.totalCount,
-						SharedLocals.maxIncMax, SharedLocals.maxIncMin, SharedLocals.maxIncMean,
-						SharedLocals.maxExcMax, SharedLocals.maxExcMin, SharedLocals.maxExcMean,
+					inclusive, exclusive, count, maxInc, maxExc, minInc, minExc, incMean, excMean = report[key]
+
+					indentStr = level[2]
+					childIndentStr = indentStr + "\t"
+					grandchildIndentStr = childIndentStr + "\t"
+					# Each entry, with whatever closes the previous sibling and opens its own children, is a single write
+					write("".join((
+						level[3],
+						itemfmt.format(
+							key[level[1]:],
+							inclusive,
+							exclusive,
+							count,
+							maxInc,
+							minInc,
+							incMean,
+							maxExc,
+							minExc,
+							excMean,
+						),
+						grandchildIndentStr,
+						"[",
+					)))
+					level[3] = childIndentStr + "],\n\n" + childIndentStr
+					level[4] = childIndentStr + "]\n" + indentStr + "]\n"
+
+					totals[0] += exclusive
+					totals[1] += count
+					if maxInc > totals[2]:
+						totals[2] = maxInc
+					if minInc > totals[3]:
+						totals[3] = minInc
+					if incMean > totals[4]:
+						totals[4] = incMean
+					if maxExc > totals[5]:
+						totals[5] = maxExc
+					if minExc > totals[6]:
+						totals[6] = minExc
+					if excMean > totals[7]:
+						totals[7] = excMean
+
+					# Descend into this scope's children before moving on to its next sibling
+					levels.append([iter(children.get(key, ())), len(key) + 2, grandchildIndentStr, "\n" + grandchildIndentStr + "\t", "]\n"])
+
+			def _printReportHtml(report, threadId, numericThreadId):
+				if not report:
+					return
+				totalcount = 0
+				for key in report:
+					totalcount += report[key][Position.Count]
+
+				sortedKeys = _sortedKeys(report)
+
+				threadScriptId = threadId.replace(" ", "_")
+				write(_blocks[0].format(threadScriptId, threadId))
+
+				rootParent = "'<{}_root>',".format(threadScriptId)
+				write("\t\t\t\t\t\t['<{}_root>', null, 0, 0 ],\n".format(threadScriptId))
+				# One write per scope for both its treemap node and the node for its exclusive time
+				# Each value is passed once and repeated by the format string.
+				nodefmt = "\t\t\t\t\t\t['{0}', {1}{2}, {2}],\n\t\t\t\t\t\t['{3}', '{0}', {4}, {4}],\n"
+				for key in sortedKeys:
+					parent, _, thisKey = key.rpartition("::")
+					reportEntry = report[key]
+					write(nodefmt.format(
+						_getIdentifier(key),
+						"'" + _getIdentifier(parent) + "', " if parent else rootParent,
+						reportEntry[Position.Inclusive],
+						_getIdentifier(key + "::<inside " +thisKey + ">"),
+						max(reportEntry[Position.Exclusive], 0.0000000001),
 					))
-					annotationData = ''
-					for annotation in annotations:
-						txt, annotationThreadId, _, relativeTime = annotation
-						if annotationThreadId == numericThreadId:
-							if annotationData == '':
-								annotationData = '<div style="border:1px solid black; background-color:#ccf; width:100%;padding:10px;"><h3>Notes</h3><ul>'
-							annotationData += '<li>At <strong>' + _formatTime(relativeTime) + ':</strong> ' + txt + '</li>'
-					
-					if annotationData != '':
-						annotationData += '</ul></div>'
-							
-					f.write(_blocks[2].format(threadScriptId, threadId, annotationData))
 
-				f.write(_htmlHeader.format(name, " (Frame #{})".format(frameId) if frameId is not None else ""))
+				write(_blocks[1].format(threadScriptId, threadId))
 
-				for threadId, report in threadreports.items():
-					if threadId == threading.current_thread().ident and __name__ != "__main__":
-						continue
-					else:
-						_printReportHtml(report, "Worker Thread {}".format(threadId), threadId)
+				# Each scope's children in sorted order, so the tree is written in one pass over the keys
+				children = {}
+				for key in sortedKeys:
+					children.setdefault(key.rpartition("::")[0], []).append(key)
+
+				itemfmt = "[ \"{}\", {}, {}, {}, {}, {}, {}, {}, {}, {},\n"
+				separator = "\t\t\t\t\t"
+				totals = SharedLocals.totals
+				for key in children.get("", ()):
+					inclusive, exclusive, count, maxInc, maxExc, minInc, minExc, incMean, excMean = report[key]
+
+					write("".join((
+						separator,
+						itemfmt.format(
+							key,
+							inclusive,
+							exclusive,
+							count,
+							maxInc,
+							minInc,
+							incMean,
+							maxExc,
+							minExc,
+							excMean,
+						),
+						"\t\t\t\t\t\t[",
+					)))
+					separator = "\t\t\t\t\t],\n\t\t\t\t\t"
+
+					totals[0] += exclusive
+					totals[1] += count
+					if maxInc > totals[2]:
+						totals[2] = maxInc
+					if minInc > totals[3]:
+						totals[3] = minInc
+					if incMean > totals[4]:
+						totals[4] = incMean
+					if maxExc > totals[5]:
+						totals[5] = maxExc
+					if minExc > totals[6]:
+						totals[6] = minExc
+					if excMean > totals[7]:
+						totals[7] = excMean
+
+					_recurseHtml(report, children, key, itemfmt, 6)
+
+				write(
+					"\t\t\t\t\t]"
+					"\n\t\t\t\t]"
+				)
+				write("".join(("\n\t\t\t\tvar totals_", threadScriptId, " = [", ", ".join(map(str, totals)), "]\n")))
+				# The notes are collected in a list and joined once, rather than growing one string per note
+				annotationParts = []
+				for txt, _, _, relativeTime in annotationsByThread.get(numericThreadId, ()):
+					if not annotationParts:
+						annotationParts.append('<div style="border:1px solid black; background-color:#ccf; width:100%;padding:10px;"><h3>Notes</h3><ul>')
+					annotationParts.append('<li>At <strong>' + _formatTime(relativeTime) + ':</strong> ' + txt + '</li>')
+				
+				if annotationParts:
+					annotationParts.append('</ul></div>')
+						
+				write(_blocks[2].format(threadScriptId, threadId, "".join(annotationParts)))
 
-				if threading.current_thread().ident in threadreports and __name__ != "__main__":
-					_printReportHtml(threadreports[threading.current_thread().ident], "Main Thread", threading.current_thread().ident)
+			# Split the notes up by thread once, rather than scanning all of them for every thread's report
+			annotationsByThread = {}
+			for annotation in annotations:
+				annotationsByThread.setdefault(annotation[1], []).append(annotation)
 
-				if len(threadreports) != 1:
-					_printReportHtml(fullreport, "CUMULATIVE", 0)
+			write(_htmlHeader.format(name, " (Frame #{})".format(frameId) if frameId is not None else ""))
 
-				f.write(_htmlFooter)
+			for threadId, report in threadreports.items():
+				if threadId == mainIdent and __name__ != "__main__":
+					continue
+				else:
+					_printReportHtml(report, "Worker Thread {}".format(threadId), threadId)
 
-		else:
-			output("Perf reports:")
+			if mainIdent in threadreports and __name__ != "__main__":
+				_printReportHtml(threadreports[mainIdent], "Main Thread", mainIdent)
+
+			if len(threadreports) != 1:
+				_printReportHtml(fullreport, "CUMULATIVE", 0)
 
-			def _recurse(report, sortedKeys, prefix, replacementText, printed, itemfmt):
-				prev = (None, None)
+			write(_htmlFooter)
 
-				for key in sortedKeys:
-					if key in printed:
-						continue
+			# Encoded in one pass and written through a binary file, skipping the text layer
+			with open(output, "wb") as f:
+				f.write("".join(buf).encode("utf-8"))
 
-					if key.startswith(prefix):
-						printkey = key.replace(prefix, replacementText, 1)
-						if printkey.find("::") != -1:
-							continue
-						if prev != (None, None):
-							reportEntry = report[prev[1]]
-							reportIncMean = reportEntry[Position.Inclusive] / reportEntry[Position.Count]
-							reportExcMean = reportEntry[Position.Exclusive] / reportEntry[Position.Count]
-							output(
-								itemfmt.format(
-									prev[0],
-									_formatTime(reportEntry[Position.Inclusive]),
-									_formatTime(reportEntry[Position.Exclusive]),
-									reportEntry[Position.Count],
-									_formatTime(reportEntry[Position.MinInc]),
-									_formatTime(reportEntry[Position.MaxInc]),
-									_formatTime(reportIncMean),
-									_formatTime(reportEntry[Position.MinExc]),
-									_formatTime(reportEntry[Position.MaxExc]),
-									_formatTime(reportExcMean),
-								)
-							)
-							printed.add(prev[1])
-							_recurse(report, sortedKeys, prev[1] + "::", replacementText[:-4] + " \u2502  " + " \u251c\u2500 ", printed, itemfmt)
-						prev = (printkey, key)
-
-				if prev != (None, None):
-					printkey = prev[0].replace("\u251c", "\u2514")
-					reportEntry = report[prev[1]]
-					reportIncMean = reportEntry[Position.Inclusive] / reportEntry[Position.Count]
-					reportExcMean = reportEntry[Position.Exclusive] / reportEntry[Position.Count]
+		else:
+			output("Perf reports:")
+
+			# Many of the fields repeat (a scope that ran once has the same min, max and mean), so each
+			# distinct time is only formatted once per report
+			timeStrings = {}
+			def _reportTime(totaltime):
+				text = timeStrings.get(totaltime)
+				if text is None:
+					text = timeStrings[totaltime] = _formatTime(totaltime)
+				return text
+
+			def _recurse(report, children, parentKey, replacementText, itemfmt):
+				keys = children.get(parentKey, ())
+				prefixLen = len(parentKey) + 2
+				last = len(keys) - 1
+				for i, key in enumerate(keys):
+					printkey = replacementText + key[prefixLen:]
+					if i == last:
+						printkey = printkey.replace("\u251c", "\u2514")
+						childText = replacementText[:-4] + "    " + " \u251c\u2500 "
+					else:
+						childText = replacementText[:-4] + " \u2502  " + " \u251c\u2500 "
+					inclusive, exclusive, count, maxInc, maxExc, minInc, minExc, incMean, excMean = report[key]
 					output(
 						itemfmt.format(
 							printkey,
-							_formatTime(reportEntry[Position.Inclusive]),
-							_formatTime(reportEntry[Position.Exclusive]),
-							reportEntry[Position.Count],
-							_formatTime(reportEntry[Position.MinInc]),
-							_formatTime(reportEntry[Position.MaxInc]),
-							_formatTime(reportIncMean),
-							_formatTime(reportEntry[Position.MinExc]),
-							_formatTime(reportEntry[Position.MaxExc]),
-							_formatTime(reportExcMean),
+							_reportTime(inclusive),
+							_reportTime(exclusive),
+							count,
+							_reportTime(minInc),
+							_reportTime(maxInc),
+							_reportTime(incMean),
+							_reportTime(minExc),
+							_reportTime(maxExc),
+							_reportTime(excMean),
 						)
 					)
-					printed.add(prev[1])
-					_recurse(report, sortedKeys, prev[1] + "::", replacementText[:-4] + "    " + " \u251c\u2500 ", printed, itemfmt)
+					_recurse(report, children, key, childText, itemfmt)
 
 			def _alteredKey(key):
-				return re.sub("([^:]*::)", "    ", key)
+				return _parentScopeRe.sub("    ", key)
 
 			def _printReport(report, threadId):
 				if not report:
@@ -1036,47 +1318,87 @@ function singleClickHandler(data) {
 				output(headerfmt.format(threadId))
 				output(line)
 				itemfmt = "| {{:{}}} | {{:>10}} | {{:>10}} | {{:>9}} | {{:>10}} | {{:>10}} | {{:>10}} | {{:>10}} | {{:>10}} | {{:>10}} |".format(maxlen)
-				printed = set()
-				sortedKeys = sorted(report, reverse=True, key=lambda x: report[x][0] if reportMode == ReportMode.TREE else report[x][1])
-				total = 0
+				sortedKeys = _sortedKeys(report)
+				# Each scope's children in sorted order, so each level of the tree is found without rescanning every key
+				children = {}
 				for key in sortedKeys:
-					if key in printed:
-						continue
-					if key.find("::") != -1:
-						continue
-					reportEntry = report[key]
+					children.setdefault(key.rpartition("::")[0], []).append(key)
+				total = 0
+				for key in children.get("", ()):
+					inclusive, exclusive, count, maxInc, maxExc, minInc, minExc, incMean, excMean = report[key]
 					output(
 						itemfmt.format(
 							key,
-							_formatTime(reportEntry[Position.Inclusive]),
-							_formatTime(reportEntry[Position.Exclusive]),
-							reportEntry[Position.Count],
-							_formatTime(reportEntry[Position.MinInc]),
-							_formatTime(reportEntry[Position.MaxInc]),
-							_formatTime(reportEntry[Position.Inclusive] / report[key][Position.Count]),
-							_formatTime(reportEntry[Position.MinExc]),
-							_formatTime(reportEntry[Position.MaxExc]),
-							_formatTime(reportEntry[Position.Exclusive] / report[key][Position.Count]),
+							_reportTime(inclusive),
+							_reportTime(exclusive),
+							count,
+							_reportTime(minInc),
+							_reportTime(maxInc),
+							_reportTime(incMean),
+							_reportTime(minExc),
+							_reportTime(maxExc),
+							_reportTime(excMean),
 						)
 					)
 					if reportMode == ReportMode.FLAT:
-						total += reportEntry[Position.Exclusive]
+						total += exclusive
 					else:
-						total += reportEntry[Position.Inclusive]
-					_recurse(report, sortedKeys, key + "::", " \u251c\u2500 ", printed, itemfmt)
+						total += inclusive
+					_recurse(report, children, key, " \u251c\u2500 ", itemfmt)
 
 				output(line)
 
 			for threadId, report in threadreports.items():
-				if threadId == threading.current_thread().ident:
+				if threadId == mainIdent:
 					continue
 				else:
 					_printReport(report, "Worker Thread {}".format(threadId))
 
-			_printReport(threadreports[threading.current_thread().ident], "Main Thread")
+			_printReport(threadreports[mainIdent], "Main Thread")
 			if len(threadreports) != 1:
 				_printReport(fullreport, "CUMULATIVE")
 
+class _ForwardToRealPerfTimer(type):
+	"""
+	Metaclass for :class:`_NullPerfTimer` that reads the public collector state off :class:`_RealPerfTimer`.
+	Read on each access rather than copied, since the setters and the report rebind these attributes.
+	"""
+	forwarded = frozenset(("minFrameTime", "minScopeNs", "annotations", "perfStack"))
+
+	def __getattr__(cls, name):
+		if name in _ForwardToRealPerfTimer.forwarded:
+			return getattr(_RealPerfTimer, name)
+		raise AttributeError(name)
+
+# Built by calling the metaclass directly, which works the same on Python 2 and 3
+_NullPerfTimerBase = _ForwardToRealPerfTimer(str("_NullPerfTimerBase"), (object,), {"__slots__": ()})
+
+class _NullPerfTimer(_NullPerfTimerBase):
+	"""
+	Stand-in for :class:`PerfTimer` while perf tracking is disabled. Timers do nothing; reporting
+	still prints whatever was collected while tracking was enabled.
+	"""
+	__slots__ = ()
+
+	def __init__(self, blockName, frame=None):
+		pass
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, excType, excVal, excTb):
+		pass
+
+	@staticmethod
+	def Note(txt, frame=None):
+		pass
+
+	setMinFrameTime = staticmethod(_RealPerfTimer.setMinFrameTime)
+	setMinScopeNs = staticmethod(_RealPerfTimer.setMinScopeNs)
+	PrintPerfReport = staticmethod(_RealPerfTimer.PrintPerfReport)
+
+PerfTimer = _RealPerfTimer
+
 if __name__ == "__main__":
 	class Operation:
 		Enter = 0
@@ -1096,8 +1418,8 @@ if __name__ == "__main__":
 			now = 0
 		def test(recursion, name, iter, frame, thread):
 			import random
-			with PerfTimer(name, frame) as pt:
-				pt.threadId = thread
+			with PerfTimer(name, frame):
+				PerfTimer.perfStack.tid = thread
 				Shared.now += random.randint(10000, 20000)
 				if recursion < 3:
 					for i in range(random.randint(0, 3)):
@@ -1165,80 +1487,122 @@ if __name__ == "__main__":
 				recordings = []
 				count = struct.unpack("<L", f.read(4))[0]
 				print("File provides {} events. Loading data...".format(count))
+				# Read the rest of the file in one go and unpack each event from the buffer, rather than
+				# making two small reads per event. Names vary in length, so events are walked one at a time.
+				eventHeader = struct.Struct("<bQiQH")
+				data = f.read()
+				offset = 0
+				# The same few names repeat for every event, so each distinct one is only cleaned up
+				# (and decoded, on Python 3) the first time it's seen
+				names = {}
+				decodeNames = sys.version_info[0] >= 3
 				i = 0
 				for _ in range(count):
 					i += 1
-					if i % 10000 == 0:
+					# Progress every 8192 events, which is a mask rather than a division per event
+					if not i & 8191:
 						sys.stdout.write("\r... {} ({:.1f}%)".format(i, i/count*100))
-					line = list(struct.unpack("<bQiQH", f.read(1+8+4+8+2)))
-					name = b""
-					name = f.read(line[4])
-					line[4] = name.replace(b"::", b".")
-					recordings.append(line)
+						sys.stdout.flush()
+					operation, threadId, frameId, timestamp, nameLen = eventHeader.unpack_from(data, offset)
+					offset += eventHeader.size
+					rawName = data[offset:offset + nameLen]
+					offset += nameLen
+					name = names.get(rawName)
+					if name is None:
+						name = rawName.replace(b"::", b".")
+						if decodeNames:
+							name = name.decode("ascii")
+						names[rawName] = name
+					recordings.append((operation, threadId, frameId, timestamp, name))
 				print("\rData loaded, processing...")
 
 			else:
 				f.seek(0, os.SEEK_SET)
 				import json
 				print("File is not binary. Processing as JSON...")
-				recordings = json.load(f)
+				# Normalized to what the integer columns hold: whole-nanosecond timestamps, integer frames, and
+				# thread ids folded into the unsigned 64-bit range the binary format uses (they only need to be unique)
+				recordings = [
+					(operation, int(threadId) & 0xFFFFFFFFFFFFFFFF, int(frameId), int(round(timestamp)), name)
+					for operation, threadId, frameId, timestamp, name in json.load(f)
+				]
 				print("File provides {} events, processing...".format(len(recordings)))
 
+		records = PerfTimer._threadRecords()
 		stacks = {}
+		# When each thread's last outermost scope ended, by (thread, frame)
 		lastEnd = {}
+		# This loop runs once per event, so everything it touches is bound to a local first, and scopes are
+		# looked up in the interned table directly, only taking the lock for ones not seen before.
+		record = records.record
+		appendScopeId = records.scopeIds.append
+		appendInc = records.inc.append
+		appendExc = records.exc.append
+		appendTid = records.tid.append
+		appendFrame = records.frame.append
+		appendIncstart = records.incstart.append
+		appendEnd = records.end.append
+		scopeNodes = PerfTimer._scopeNodes
+		internScope = PerfTimer._internScope
+		enterOp = Operation.Enter
+		exitOp = Operation.Exit
+		noteOp = Operation.Note
+		eventCount = len(recordings)
 		i = 0
 		for recording in recordings:
 			i += 1
-			if i % 10000 == 0:
-				sys.stdout.write("\r... {} ({:.1f}%)".format(i, i/len(recordings)*100))
+			if not i & 8191:
+				sys.stdout.write("\r... {} ({:.1f}%)".format(i, i/eventCount*100))
+				sys.stdout.flush()
 			operation, threadId, frameId, timestamp, name = recording
-			timestamp /= 1000 * 1000 * 1000
-			if sys.version_info[0] >= 3 and isinstance(name, bytes):
-				name = name.decode("ascii")
 
-			if operation == Operation.Enter:
+			if operation == enterOp:
 				timer = PerfTimer(name, frameId if frameId >= 0 else None)
-				timer.threadId = threadId
-				try:
-					prev = stacks[threadId][-1]
+				stack = stacks.get(threadId)
+				if stack:
+					prev = stack[-1]
 					prev.exclusive += timestamp - prev.excstart
-					timer.scopeName = prev.scopeName + "::" + timer.blockName
-
-					stacks[threadId].append(timer)
-				except:
-					lastEndThisFrameAndThread = lastEnd.get(threadId, {}).get(frameId, None)
+					parentId = prev.scopeId
+					stack.append(timer)
+				else:
+					lastEndThisFrameAndThread = lastEnd.get((threadId, frameId))
 					if lastEndThisFrameAndThread is not None:
-						lastEnd.setdefault(threadId, {})[frameId] = None
+						lastEnd[(threadId, frameId)] = None
 						duration = timestamp - lastEndThisFrameAndThread
-						PerfTimer.perfQueue.append(
-							("<unknown>", duration, duration, threadId, frameId, lastEndThisFrameAndThread, timestamp))
-						
+						record(internScope(_rootScope, "<unknown>"), duration, duration, threadId, frameId if frameId >= 0 else None, lastEndThisFrameAndThread, timestamp)
+
+					parentId = _rootScope
 					stacks[threadId] = [timer]
 
+				scopeId = scopeNodes.get((parentId, name))
+				if scopeId is None:
+					scopeId = internScope(parentId, name)
+				timer.scopeId = scopeId
 				timer.incstart = timestamp
 				timer.excstart = timestamp
 
-			elif operation == Operation.Exit:
-				timer = stacks[threadId][-1]
-				try:
-					prev = stacks[threadId][-2]
-					prev.excstart = timestamp
-				except:
-					lastEnd.setdefault(threadId, {})[frameId] = timestamp
-					pass
-
-				timer.exclusive += timestamp - timer.excstart
-				timer.inclusive = timestamp - timer.incstart
-
-				PerfTimer.perfQueue.append(
-					(timer.scopeName, timer.inclusive, timer.exclusive, timer.threadId, timer.frame, timer.incstart, timestamp))
-				stacks[threadId].pop()
-			elif operation == Operation.Note:
+			elif operation == exitOp:
+				stack = stacks[threadId]
+				timer = stack.pop()
+				if stack:
+					stack[-1].excstart = timestamp
+				else:
+					lastEnd[(threadId, frameId)] = timestamp
+
+				# Same as _PerfRecords.record(), written out here to save a call per event
+				appendScopeId(timer.scopeId)
+				appendInc(timestamp - timer.incstart)
+				appendExc(timer.exclusive + timestamp - timer.excstart)
+				appendTid(threadId)
+				appendFrame(_noFrame if timer.frame is None else timer.frame)
+				appendIncstart(timer.incstart)
+				appendEnd(timestamp)
+			elif operation == noteOp:
 				PerfTimer.annotations.append((name, threadId, frameId, timestamp))
 			else:
 				print("\rInvalid operation: {}".format(operation))
 				exit(1)
-				
+
 		print("\rFinished processing {} events. Generating output...".format(len(recordings)))
 
 	PerfTimer.PrintPerfReport(ReportMode.HTML, sys.argv[2], sys.argv[3])